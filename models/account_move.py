@@ -1,15 +1,81 @@
 import base64
+import functools
 import logging
 from lxml import html
 from dateutil.relativedelta import relativedelta
 import re
 
-from datetime import datetime
-from odoo import models, fields, api, _
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from odoo import models, fields, api, tools, _
 from odoo.exceptions import UserError, ValidationError
+from odoo.tools import split_every
+from odoo.tools.sql import column_exists, create_column
+
+from ..services.hka_connector import HKASendUncertainError, json_dumps, json_encode, json_loads
 
 _logger = logging.getLogger(__name__)
 
+# Runs of whitespace collapsed in the narration lines
+_WS_RE = re.compile(r'\s+')
+
+# Constants for file types: extension and mimetype
+_FILE_TYPES = {
+    'XML': ('xml', 'application/xml'),
+    'PDF': ('pdf', 'application/pdf'),
+    'CDR': ('zip', 'application/zip'),
+}
+
+# Files downloaded from HKA: type, flag field, extension and mimetype, resolved once
+_DOWNLOADS = tuple(
+    (type, done_field, *_FILE_TYPES[type])
+    for type, done_field in (
+        ('XML', 'hka_xml_file'),
+        ('PDF', 'hka_pdf_file'),
+        ('CDR', 'hka_cdr_file'),
+    )
+)
+
+# Maximum number of sending attempts before leaving an invoice rejected
+_HKA_MAX_RETRIES = 3
+# Maximum age of a payload kept for retries, bounding the changes its dates
+# cannot detect (taxes, exchange rate, emission time)
+_HKA_PAYLOAD_MAX_AGE = timedelta(hours=1)
+
+
+@functools.lru_cache(maxsize=256)
+def _parse_narration(narration):
+    """
+    Extract the key-value pairs of an HTML narration, one per <p> line split
+    by its first colon. Cached, as invoices often share template narrations.
+
+    :param narration: HTML narration.
+    :return: Tuple of (title, value) tuples.
+    :rtype: tuple
+    """
+    result = []
+    debug = _logger.isEnabledFor(logging.DEBUG)
+    if debug:
+        _logger.debug("Preparing HKA information from narration: %s", narration)
+
+    doc = html.fromstring(narration)
+    paragraphs = doc.xpath('//p')
+    if debug:
+        _logger.debug("Paragraphs found: %s", paragraphs)
+
+    for p in paragraphs:
+        clean_line = _WS_RE.sub(' ', p.text_content()).strip()
+
+        if debug:
+            _logger.debug("Processing line: %s", clean_line)
+
+        if ':' in clean_line:
+            key, value = map(str.strip, clean_line.split(':', 1))
+            result.append((key, value))
+
+    return tuple(result)
+
 
 class AccountMove(models.Model):
     """
@@ -26,7 +92,8 @@ class AccountMove(models.Model):
         ('sent',    'Enviado'),
         ('accepted','Aceptado'),
         ('rejected','Rechazado'),
-    ], string="Estado HKA")
+        ('unknown', 'Sin Confirmar'),
+    ], string="Estado HKA", index=True)
     hka_cpe_number = fields.Char(string="N° CPE")
     hka_sent_date = fields.Datetime(string="Fecha Envío HKA")
     hka_error_msg = fields.Text(string="Error HKA")
@@ -34,6 +101,19 @@ class AccountMove(models.Model):
     hka_xml_file = fields.Boolean(string="XML Descargado", default=False, copy=False)
     hka_pdf_file = fields.Boolean(string="PDF Descargado", default=False, copy=False)
     hka_cdr_file = fields.Boolean(string="CDR Descargado", default=False, copy=False)
+    hka_payload = fields.Binary(string="Payload HKA", attachment=True, copy=False)
+    hka_payload_date = fields.Datetime(string="Fecha Payload HKA", copy=False)
+    hka_payload_check_date = fields.Datetime(string="Fecha Revisión Payload HKA", copy=False)
+    hka_eligible = fields.Boolean(
+        string="Emitible por HKA",
+        compute="_compute_hka_eligible",
+        store=True,
+    )
+    hka_files_complete = fields.Boolean(
+        string="Documentos HKA Descargados",
+        compute="_compute_hka_files_complete",
+        store=True,
+    )
 
     l10n_pe_edi_operation_type_code_id = fields.Many2one(
         comodel_name="l10n_pe_edi.catalog.51",
@@ -67,15 +147,50 @@ class AccountMove(models.Model):
         related='company_id.partner_id',
         string="Partner de la compañía",
         store=False,
-        readonly=True
+        readonly=True,
     )
 
-    # Constants for file types
-    _FILE_TYPES = {
-        'XML': ('xml', 'application/xml'),
-        'PDF': ('pdf', 'application/pdf'),
-        'CDR': ('zip', 'application/zip'),
-    }
+    def _auto_init(self):
+        """
+        Create and fill the stored HKA flags in SQL, so installing or updating
+        the module does not compute them in Python for every existing move.
+        """
+        cr = self.env.cr
+        if not column_exists(cr, 'account_move', 'hka_eligible'):
+            create_column(cr, 'account_move', 'hka_eligible', 'boolean')
+            cr.execute("""
+                UPDATE account_move m
+                   SET hka_eligible = (m.move_type = 'out_invoice' AND j.type = 'sale')
+                  FROM account_journal j
+                 WHERE j.id = m.journal_id
+            """)
+        if not column_exists(cr, 'account_move', 'hka_files_complete'):
+            create_column(cr, 'account_move', 'hka_files_complete', 'boolean')
+            # En una instalación nueva aún no hay documentos descargados
+            if column_exists(cr, 'account_move', 'hka_xml_file'):
+                cr.execute("""
+                    UPDATE account_move
+                       SET hka_files_complete = true
+                     WHERE hka_xml_file AND hka_pdf_file AND hka_cdr_file
+                """)
+        return super()._auto_init()
+
+    def init(self):
+        """
+        Create partial indexes covering the invoices the HKA crons look for, so
+        their searches stay small index lookups as `account_move` grows.
+        """
+        super().init()
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_hka_pending_idx
+                ON account_move (hka_status)
+             WHERE hka_status IN ('to_send', 'sent') AND state = 'posted' AND hka_eligible
+        """)
+        self.env.cr.execute("""
+            CREATE INDEX IF NOT EXISTS account_move_hka_download_idx
+                ON account_move (hka_files_complete)
+             WHERE hka_status = 'sent'
+        """)
 
     @api.onchange('l10n_pe_edi_detraction_type_id')
     def _onchange_detraction_type(self):
@@ -93,16 +208,44 @@ class AccountMove(models.Model):
         catalog51 = self.env['l10n_pe_edi.catalog.51']
         if self.l10n_pe_edi_detraction_type_id:
             # Operation type code for detraction
-            self.l10n_pe_edi_operation_type_code_id = catalog51.search([('code', '=', '1001')], limit=1)
+            self.l10n_pe_edi_operation_type_code_id = catalog51.browse(self._get_catalog51_id('1001'))
             # estos campos se habilitan en la vista
             # self.l10n_pe_edi_detraction_payment_type_id = company_id.l10n_pe_edi_detraction_payment_type_id or False
             # self.l10n_pe_edi_detraction_bank_account = company_id.l10n_pe_edi_detraction_bank_account_id or False
         else:
             # Operation type code for normal invoice
-            self.l10n_pe_edi_operation_type_code_id = catalog51.search([('code', '=', '0101')], limit=1)
+            self.l10n_pe_edi_operation_type_code_id = catalog51.browse(self._get_catalog51_id('0101'))
             self.l10n_pe_edi_detraction_payment_type_id = False
             self.l10n_pe_edi_detraction_bank_account = False
 
+    @api.model
+    @tools.ormcache('code')
+    def _get_catalog51_id(self, code):
+        """
+        Return the id of the SUNAT catalog 51 (operation type) record with the given code.
+
+        :param code: Operation type code, e.g. '0101'.
+        :return: Record id, or False if not found.
+        :rtype: int
+        """
+        return self.env['l10n_pe_edi.catalog.51'].search([('code', '=', code)], limit=1).id
+
+    @api.depends('move_type', 'journal_id.type')
+    def _compute_hka_eligible(self):
+        """
+        Flags the customer invoices of sale journals, the only ones issued through HKA.
+        """
+        for move in self:
+            move.hka_eligible = move.move_type == 'out_invoice' and move.journal_id.type == 'sale'
+
+    @api.depends('hka_xml_file', 'hka_pdf_file', 'hka_cdr_file')
+    def _compute_hka_files_complete(self):
+        """
+        Flags the invoices whose XML, PDF and CDR files have all been downloaded.
+        """
+        for move in self:
+            move.hka_files_complete = move.hka_xml_file and move.hka_pdf_file and move.hka_cdr_file
+
     @api.depends(
         'l10n_pe_edi_detraction_type_id',
         'l10n_pe_edi_detraction_type_id.rate',
@@ -113,27 +256,34 @@ class AccountMove(models.Model):
         Computes the total detraction amount based on the invoice total
         and the detraction percentage defined in the selected detraction type.
         """
+        # Read the rates and currencies of all the moves at once
+        self.mapped('l10n_pe_edi_detraction_type_id.rate')
+        self.mapped('currency_id.rounding')
         for move in self:
             if move.l10n_pe_edi_detraction_type_id:
                 rate = move.l10n_pe_edi_detraction_type_id.rate or 0.0
-                detraction = round(move.amount_total * rate / 100, 2)
+                detraction = move.currency_id.round(move.amount_total * rate / 100)
                 move.l10n_pe_edi_total_detraction = detraction
                 # move.l10n_pe_edi_total_detraction_signed = detraction
             else:
                 move.l10n_pe_edi_total_detraction = 0.0
                 # move.l10n_pe_edi_total_detraction_signed = 0.0
 
-    def _prepare_hka_header(self):
+    def _prepare_hka_header(self, invoice_date, invoice_date_due):
         """
         Prepare the electronic invoice header required by HKA.
 
+        The emission time is taken from the context key `hka_emission_time` when
+        the caller already computed it for a whole batch (see `_send_hka_batch`).
+
+        :param invoice_date: Invoice date formatted as 'YYYY-MM-DD'.
+        :param invoice_date_due: Due date formatted as 'YYYY-MM-DD'.
         :return: Dict with header metadata.
         :rtype: dict
         """
-        invoice_date = self.invoice_date.strftime("%Y-%m-%d")
-        invoice_date_due = self.invoice_date_due.strftime("%Y-%m-%d")
-        time_str = fields.Datetime.context_timestamp(self, datetime.now()).strftime("%H:%M:%S")
-        serie, correlativo = self.name.split('-', 1)
+        time_str = self.env.context.get('hka_emission_time') \
+            or fields.Datetime.context_timestamp(self, datetime.now()).strftime("%H:%M:%S")
+        serie, _sep, correlativo = self.name.partition('-')
         return {
             "fechaEmision": invoice_date,
             "fechaVencimiento": invoice_date_due,
@@ -153,44 +303,33 @@ class AccountMove(models.Model):
         """
         Prepare issuer (company) data for the payload.
 
+        Uses the per-company cache passed in the context key `hka_emisor_cache`
+        when available (see `_send_hka_batch`).
+
         :return: Dict with issuer info.
         :rtype: dict
         """
-        company = self.company_id
-        return {
-            "ruc": company.vat or '',
-            "nombreComercial": company.name,
-            # "lugarExpedicion": company.zip or '',
-            "lugarExpedicion": '0000',
-            "domicilioFiscal": company.street or '',
-            "urbanizacion": company.street2 or '',
-            "distrito": company.city or '',
-            "provincia": company.state_id.name or '',
-            "departamento": company.state_id.name or '',
-            "codigoPais": company.country_id.code or '',
-            "ubigeo": company.partner_id.zip or '',
-        }
+        emisor_cache = self.env.context.get('hka_emisor_cache') or {}
+        emisor = emisor_cache.get(self.company_id.id)
+        if emisor is None:
+            emisor = self.company_id._prepare_hka_emisor()
+        return emisor
 
     def _prepare_hka_receptor(self):
         """
         Prepare customer data for the payload.
 
+        Uses the per-partner cache passed in the context key `hka_receptor_cache`
+        when available (see `_send_hka_batch`).
+
         :return: Dict with customer info.
         :rtype: dict
         """
-        partner = self.partner_id
-        id_type = partner.l10n_latam_identification_type_id.l10n_pe_vat_code or ''
-        return {
-            "tipoDocumento": id_type,
-            "numDocumento": partner.vat or '',
-            "razonSocial": partner.name,
-            "notificar": "NO",
-            "pais": partner.country_id.code or '',
-            "provincia": partner.state_id.name or '',
-            "departamento": partner.state_id.name or '',
-            "distrito": partner.city or '',
-            "direccion": partner.street or '',
-        }
+        receptor_cache = self.env.context.get('hka_receptor_cache') or {}
+        receptor = receptor_cache.get(self.partner_id.id)
+        if receptor is None:
+            receptor = self.partner_id._prepare_hka_receptor()
+        return receptor
 
     def _prepare_hka_items(self):
         """
@@ -203,34 +342,42 @@ class AccountMove(models.Model):
         :rtype: list
         """
         items = []
-        for idx, line in enumerate(self.invoice_line_ids, start=1):
+        lines = self.invoice_line_ids
+        # Cargar los impuestos y unidades de todas las líneas en una sola consulta
+        lines.mapped('tax_ids.amount')
+        lines.mapped('product_uom_id.l10n_pe_edi_uom_code_id.code')
+        for idx, line in enumerate(lines, start=1):
             quantity = float(line.quantity)
             if not quantity:
                 continue  # evitar división por cero
 
             # Obtener el IGV (suponemos uno por línea)
-            igv_amounts = line.tax_ids.filtered(lambda t: t.amount and t.type_tax_use == 'sale').mapped('amount')
-            igv_pct = igv_amounts[0] if igv_amounts else 0.0
+            igv_pct = next((t.amount for t in line.tax_ids if t.amount and t.type_tax_use == 'sale'), 0.0)
 
             # Calcular el valor unitario sin IGV
             valor_unitario_bi = round(line.price_subtotal / quantity, 2)
             valor_venta_qxbi = round(valor_unitario_bi * quantity, 2)
             precio_unitario_con_igv = round(valor_unitario_bi * (1 + igv_pct / 100), 2)
+            # Mismo orden de operaciones que account.tax (base * amount / 100)
             monto_igv = round(valor_venta_qxbi * igv_pct / 100, 2)
 
+            # Formatear una sola vez los importes repetidos
+            valor_venta_qxbi_str = f"{valor_venta_qxbi:.2f}"
+            monto_igv_str = f"{monto_igv:.2f}"
+
             items.append({
                 "numeroOrden": str(idx),
                 "descripcion": line.name,
                 "cantidad": str(int(quantity)),
                 "unidadMedida": line.product_uom_id.l10n_pe_edi_uom_code_id.code or 'NIU',
                 "valorUnitarioBI": f"{valor_unitario_bi:.2f}",
-                "valorVentaItemQxBI": f"{valor_venta_qxbi:.2f}",
+                "valorVentaItemQxBI": valor_venta_qxbi_str,
                 "precioVentaUnitarioItem": f"{precio_unitario_con_igv:.2f}",
-                "montoTotalImpuestoItem": f"{monto_igv:.2f}",
+                "montoTotalImpuestoItem": monto_igv_str,
                 "IGV": {
-                    "baseImponible": f"{valor_venta_qxbi:.2f}",
+                    "baseImponible": valor_venta_qxbi_str,
                     "porcentaje": f"{igv_pct:.2f}",
-                    "monto": f"{monto_igv:.2f}",
+                    "monto": monto_igv_str,
                     "tipo": "10",
                 }
             })
@@ -255,14 +402,14 @@ class AccountMove(models.Model):
             }
         }
 
-    def _prepare_hka_payment(self):
+    def _prepare_hka_payment(self, date):
         """
         Define payment terms (assumes cash payment on invoice date).
 
+        :param date: Invoice date formatted as 'YYYY-MM-DD'.
         :return: Dict with payment info.
         :rtype: dict
         """
-        date = self.invoice_date.strftime("%Y-%m-%d")
         pen = self.env.ref('base.PEN', raise_if_not_found=False)
 
         return {
@@ -282,30 +429,14 @@ class AccountMove(models.Model):
         :return: List of dicts with 'seccion', 'titulo', and 'valor' per line.
         :rtype: list
         """
-        result = []
+        if not self.narration:
+            return []
 
-        if self.narration:
-            _logger.info(f"Preparing HKA information from narration: {self.narration}")
-
-            doc = html.fromstring(self.narration)
-            paragraphs = doc.xpath('//p')
-            _logger.info(f"Paragraphs found: {paragraphs}")
-
-            for p in paragraphs:
-                full_text = p.text_content().strip()
-                clean_line = re.sub(r'\s+', ' ', full_text)
-
-                _logger.info(f"Processing line: {clean_line}")
-
-                if ':' in clean_line:
-                    key, value = map(str.strip, clean_line.split(':', 1))
-                    result.append({
-                        "seccion": "1",
-                        "titulo": key,
-                        "valor": value
-                    })
-
-        return result
+        return [{
+            "seccion": "1",
+            "titulo": key,
+            "valor": value
+        } for key, value in _parse_narration(self.narration)]
     
     def _prepare_hka_detraction(self):
         """
@@ -322,6 +453,16 @@ class AccountMove(models.Model):
             "porcentaje": self.l10n_pe_edi_detraction_type_id.rate,
         }]
     
+    @api.model
+    def _get_hka_immediate_term_id(self):
+        """
+        Return the id of the immediate payment term, or False if it does not exist.
+
+        :rtype: int
+        """
+        immediate_term = self.env.ref('account.account_payment_term_immediate', raise_if_not_found=False)
+        return immediate_term.id if immediate_term else False
+
     def _prepare_hka_payment_method(self):
         """
         Define payment terms for 'facturaNegociable' in HKA.
@@ -329,12 +470,17 @@ class AccountMove(models.Model):
         If the invoice uses immediate payment, sets 'Contado' mode.
         If it uses credit terms, sets 'Credito' mode and builds the list of dues.
 
+        The immediate payment term is taken from the context key `hka_immediate_term_id`
+        when the caller already resolved it for a whole batch (see `_send_hka_batch`).
+
         :return: Dict for facturaNegociable including 'modoPago', 'montoNetoPendiente', and optionally 'cuotasFactura'.
         :rtype: dict
         """
         self.ensure_one()
-        immediate_term = self.env.ref('account.account_payment_term_immediate', raise_if_not_found=False)
-        is_credit = self.invoice_payment_term_id and self.invoice_payment_term_id != immediate_term
+        immediate_term_id = self.env.context.get('hka_immediate_term_id')
+        if immediate_term_id is None:
+            immediate_term_id = self._get_hka_immediate_term_id()
+        is_credit = self.invoice_payment_term_id and self.invoice_payment_term_id.id != immediate_term_id
         net_amount = self.amount_total - self.l10n_pe_edi_total_detraction
 
         payment_info = {
@@ -361,7 +507,7 @@ class AccountMove(models.Model):
                 total_allocated += amount
 
                 dues.append({
-                    "fechaPagoCuota": due_date.strftime("%Y-%m-%d"),
+                    "fechaPagoCuota": due_date.isoformat(),
                     "identificadorCuota": f"Cuota{idx:03}",
                     "montoPagoCuota": f"{amount:.2f}"
                 })
@@ -380,23 +526,17 @@ class AccountMove(models.Model):
         """
         self.ensure_one()
         _logger.info("Preparing HKA payload for %s", self.name)
-        header = self._prepare_hka_header()
-        emisor = self._prepare_hka_emisor()
-        receptor = self._prepare_hka_receptor()
-        items = self._prepare_hka_items()
-        totals = self._prepare_hka_totals()
-        payment = self._prepare_hka_payment()
-        payment_method = self._prepare_hka_payment_method()
-
-        payload = {
-            **header,
-            "emisor": emisor,
-            "receptor": receptor,
-            "facturaNegociable": payment_method,
-            "producto": items,
-            "totales": totals,
-            "pago": payment,
-        }
+        invoice_date = self.invoice_date.isoformat()
+        invoice_date_due = self.invoice_date_due.isoformat()
+
+        # The header is the base of the payload, extended in place to avoid copying it
+        payload = self._prepare_hka_header(invoice_date, invoice_date_due)
+        payload["emisor"] = self._prepare_hka_emisor()
+        payload["receptor"] = self._prepare_hka_receptor()
+        payload["facturaNegociable"] = self._prepare_hka_payment_method()
+        payload["producto"] = self._prepare_hka_items()
+        payload["totales"] = self._prepare_hka_totals()
+        payload["pago"] = self._prepare_hka_payment(invoice_date)
 
         if self.narration:
             payload["personalizacionPDF"] = self._prepare_hka_information()
@@ -404,32 +544,60 @@ class AccountMove(models.Model):
         if self.l10n_pe_edi_detraction_type_id:
             payload["detraccion"] = self._prepare_hka_detraction()
 
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Payload HKA: %s", json_dumps(payload))
+
         return payload
 
+    def _prefetch_hka_payload(self):
+        """
+        Load into the cache, for the whole recordset at once, the data read while
+        preparing the payloads, so iterating the invoices does not query it one by one.
+        """
+        self.invoice_line_ids.read([
+            'name', 'quantity', 'price_unit', 'price_subtotal', 'price_total', 'tax_ids', 'product_uom_id',
+            'write_date',
+        ])
+        lines = self.invoice_line_ids
+        lines.mapped('tax_ids.amount')
+        lines.mapped('product_uom_id.l10n_pe_edi_uom_code_id.code')
+        self.mapped('l10n_latam_document_type_id.code')
+        self.mapped('l10n_pe_edi_operation_type_code_id.code')
+        self.mapped('partner_id.l10n_latam_identification_type_id.l10n_pe_vat_code')
+        self.mapped('partner_id.country_id.code')
+        self.mapped('partner_id.state_id.name')
+        self.mapped('company_id.state_id')
+        self.mapped('company_id.partner_id.zip')
+        self.mapped('l10n_pe_edi_detraction_type_id.code')
+        self.mapped('l10n_pe_edi_detraction_payment_type_id.code')
+        self.mapped('l10n_pe_edi_detraction_bank_account.acc_number')
+
     def button_send_hka(self):
+        """
+        Queue the invoice for HKA: wake up the sending cron instead of calling
+        HKA here, so the request does not wait on the web service.
+
+        Invoices whose sending could not be confirmed ('unknown') are never
+        requeued by the cron, only from here, once checked in HKA that the
+        document was not issued.
+        """
         self.ensure_one()
-        _logger.info("Enviando %s a HKA", self.name)
-        domain = self._domain_pending_send() + [('id', '=', self.id)]
 
-        if not self.search(domain):
+        if not (self.hka_eligible and self.hka_status in ('to_send', 'unknown') and self.state == 'posted'):
             raise UserError(_("No se puede enviar la factura por HKA."))
-        
-        connector = self.env['hka.connector.service'].sudo().get_client()
-        
-        try:
-            sent = self._send_to_hka(connector)
-            self._handle_retry(sent)
-        except Exception as e:
-            _logger.error("Error al enviar %s a HKA: %s", self.name, e)
-        
-        _logger.info("Envío a HKA completado para %s", self.name)
+
+        if self.hka_status == 'unknown':
+            self.hka_status = 'to_send'
+
+        _logger.info("Encolando %s para envío a HKA", self.name)
+        self.env.ref('hka_account_connector.ir_cron_send_hka').sudo()._trigger()
 
     def action_post(self):
         """
         Hook into `action_post` to mark invoice as 'to_send' for HKA processing.
         """
         res = super(AccountMove, self).action_post()
-        to_send = self.filtered(lambda m: m.move_type == 'out_invoice' and m.journal_id.type == 'sale')
+        to_send = self.filtered('hka_eligible')
 
         if to_send:
             to_send.write({
@@ -445,8 +613,7 @@ class AccountMove(models.Model):
         """
         return [
             ('hka_status', '=', 'to_send'),
-            ('move_type',   '=', 'out_invoice'),
-            ('journal_id.type', '=', 'sale'),
+            ('hka_eligible', '=', True),
             ('state', '=', 'posted'),
         ]
 
@@ -457,143 +624,430 @@ class AccountMove(models.Model):
         """
         return [
             ('hka_status', '=', 'sent'),
-            ('move_type',   '=', 'out_invoice'),
-            ('journal_id.type', '=', 'sale'),
+            ('hka_eligible', '=', True),
             ('state', '=', 'posted'),
-            '|', '|',
-            ('hka_xml_file', '=', False),
-            ('hka_pdf_file', '=', False),
-            ('hka_cdr_file', '=', False),
+            ('hka_files_complete', '=', False),
         ]
 
     # Central attach helper
-    def _attach_file(self, data, ext, mimetype):
+    def _prepare_attachment_vals(self, datas, ext, mimetype):
         """
-        Attach a binary file (XML, PDF, or CDR) to the invoice.
+        Prepare the values to attach a binary file (XML, PDF, or CDR) to the invoice.
 
-        :param data: Binary content of the file.
+        HKA already returns the files base64-encoded, so they are stored as is
+        instead of being decoded and encoded again.
+
+        :param datas: Base64-encoded content of the file.
         :param ext: File extension (e.g., 'xml').
         :param mimetype: MIME type of the file.
+        :return: Values for `ir.attachment.create`.
+        :rtype: dict
         """
-        self.env['ir.attachment'].create({
+        return {
             'name':      f"{self.name}.{ext}",
             'type':      'binary',
-            'datas':     base64.b64encode(data),
+            'datas':     datas,
             'mimetype':  mimetype,
             'res_model': 'account.move',
             'res_id':    self.id,
-        })
+        }
+
+    @api.model
+    def _attach_hka_files(self, files):
+        """
+        Attach files returned by HKA to their invoices and set their download flags.
+
+        The attachments are created in a single batch, without tracking. If that
+        fails (e.g. HKA returned a malformed base64 file), each one is created in
+        its own savepoint, so a bad file does not lose the others; the files that
+        could not be attached keep their flag unset and are downloaded again.
 
-    def _handle_retry(self, sent):
+        :param files: List of tuples (flag field, values built by `_prepare_attachment_vals`).
+        """
+        if not files:
+            return
+
+        Attachment = self.env['ir.attachment'].with_context(
+            mail_notrack=True,
+            tracking_disable=True,
+        )
+        try:
+            with self.env.cr.savepoint():
+                Attachment.create([vals for _done_field, vals in files])
+            attached = files
+        except Exception as e:
+            _logger.warning("No se pudieron adjuntar los documentos HKA en lote: %s", e)
+            attached = []
+            for done_field, vals in files:
+                try:
+                    with self.env.cr.savepoint():
+                        Attachment.create(vals)
+                    attached.append((done_field, vals))
+                except Exception as e:
+                    _logger.error("Error al adjuntar %s: %s", vals['name'], e)
+
+        flags_by_invoice = defaultdict(dict)
+        for done_field, vals in attached:
+            flags_by_invoice[vals['res_id']][done_field] = True
+        self._write_grouped(flags_by_invoice)
+
+    @api.model
+    def _write_grouped(self, vals_by_id):
+        """
+        Write per-invoice values grouping the invoices that share the same values,
+        so each distinct set of values is written with a single `write()`.
+
+        :param vals_by_id: Dict mapping invoice ids to the values to write.
+        """
+        ids_by_vals = defaultdict(list)
+        for move_id, vals in vals_by_id.items():
+            ids_by_vals[tuple(sorted(vals.items()))].append(move_id)
+
+        for vals, ids in ids_by_vals.items():
+            self.browse(ids).write(dict(vals))
+
+    def _handle_retry(self):
         """
         Retry handler to requeue invoices that failed to send.
 
-        :param sent: Boolean indicating if the document was successfully sent.
+        Increments the retry counter of all the invoices in a single UPDATE and
+        requeues the rejected ones that have not reached the maximum retries.
         """
-        max_retries = 3
-        if not sent:
-            self.hka_retry_count += 1
-            if self.hka_retry_count >= max_retries:
-                _logger.warning("Máx. reintentos alcanzados en %s", self.name)
-            else:
-                self.hka_status = 'to_send'
-        else:
-            self.hka_retry_count = 0
+        if not self:
+            return
+
+        self.flush_recordset(['hka_status', 'hka_retry_count'])
+        self.env.cr.execute("""
+            UPDATE account_move
+               SET hka_retry_count = COALESCE(hka_retry_count, 0) + 1,
+                   hka_status = CASE
+                       WHEN hka_status = 'rejected' AND COALESCE(hka_retry_count, 0) + 1 < %s THEN 'to_send'
+                       ELSE hka_status
+                   END
+             WHERE id = ANY(%s)
+         RETURNING id, hka_status
+        """, [_HKA_MAX_RETRIES, self.ids])
+        exhausted_ids = [move_id for move_id, status in self.env.cr.fetchall() if status == 'rejected']
+        self.invalidate_recordset(['hka_retry_count', 'hka_status'])
+
+        exhausted = self.browse(exhausted_ids)
+        for move in exhausted:
+            _logger.warning("Máx. reintentos alcanzados en %s", move.name)
+        # No habrá más reintentos: descartar el payload guardado
+        exhausted.filtered('hka_payload_date').write(self._clear_hka_payload_vals())
     
-    def _send_to_hka(self, connector):
+    def _check_hka_required_data(self):
         """
-        Send the invoice to HKA and update its state accordingly.
+        Check the invoice has the data required to build its HKA payload.
 
-        :param connector: HKAConnector instance.
-        :return: True if sent successfully, else False.
+        :return: Values rejecting the invoice if data is missing, else None.
+        :rtype: dict
+        """
+        if not self.l10n_latam_document_type_id_code or not self.invoice_date:
+            return {
+                'hka_status': 'rejected',
+                'hka_error_msg': _("La factura no tiene tipo de documento o fecha de emisión."),
+            }
+        if '-' not in self.name:
+            return {
+                'hka_status': 'rejected',
+                'hka_error_msg': _("El número de la factura no tiene el formato SERIE-CORRELATIVO."),
+            }
+        return None
+
+    def _get_hka_cached_payload(self):
+        """
+        Return the payload kept from a previous failed sending, if it is not
+        older than `_HKA_PAYLOAD_MAX_AGE` and neither the invoice, its lines,
+        its partner nor its company have been modified since it was last
+        checked (`hka_payload_check_date`).
+
+        :return: Cached payload, or None.
+        :rtype: dict
+        """
+        if not self.hka_payload_date or self.env.cr.now() - self.hka_payload_date > _HKA_PAYLOAD_MAX_AGE:
+            return None
+
+        check_date = self.hka_payload_check_date
+        dates = [self.write_date, self.company_id.write_date]
+        dates += (self.partner_id | self.company_id.partner_id).mapped('write_date')
+        dates += self.invoice_line_ids.mapped('write_date')
+        if not check_date or any(date and date > check_date for date in dates) or not self.hka_payload:
+            return None
+        return json_loads(base64.b64decode(self.hka_payload))
+
+    def _cache_hka_payload(self, payload):
         """
-        payload = self._prepare_hka_payload()
-        _logger.info("Payload HKA: %s", payload)
-        resp = connector.send_document(payload)
+        Keep the payload of a failed sending so the next retry can reuse it.
 
+        The dates are the transaction timestamp, the same Odoo uses for
+        `write_date`, so the writes done by the cron in this transaction do not
+        invalidate it.
+
+        :param payload: Payload sent to HKA.
+        """
+        now = self.env.cr.now()
+        self.write({
+            'hka_payload': base64.b64encode(json_encode(payload)),
+            'hka_payload_date': now,
+            'hka_payload_check_date': now,
+        })
+
+    @api.model
+    def _clear_hka_payload_vals(self):
+        """
+        Values discarding the payload kept for retries.
+
+        :rtype: dict
+        """
+        return {'hka_payload': False, 'hka_payload_date': False, 'hka_payload_check_date': False}
+
+    def _process_hka_response(self, resp, sent_date=None):
+        """
+        Compute the state of the invoice from the HKA response to its sending.
+
+        :param resp: Response of `HKAConnector.send_document`.
+        :param sent_date: Datetime to record as sending date, defaults to now.
+        :return: Tuple (vals, xml_b64) with the values to write and the
+            base64-encoded XML file, or None if HKA did not return it.
+        :rtype: tuple
+        """
         if not resp.get('estatus'):
-            self.write({
+            return {
                 'hka_status': 'rejected',
                 'hka_error_msg': resp.get('mensaje'),
-            })
-            return False
+            }, None
         
         # success
-        self.write({
+        vals = {
             'hka_status': 'sent',
             'hka_cpe_number': resp.get('numeracion'),
-            'hka_sent_date': fields.Datetime.now(),
+            'hka_sent_date': sent_date or fields.Datetime.now(),
             'hka_error_msg': False,
-        })
+            'hka_retry_count': 0,
+        }
 
-        # attach XML
-        xml_b64 = resp.get('xml') or ''
-        if xml_b64:
-            xml_data = base64.b64decode(xml_b64)
-            ext, mimetype = self._FILE_TYPES['XML']
-            self._attach_file(xml_data, ext, mimetype)
-            self.hka_xml_file = True
+        # XML, el indicador hka_xml_file se marca al adjuntarlo
+        xml_b64 = resp.get('xml') or None
+
+        return vals, xml_b64
+
+    @api.model
+    def _get_hka_cron_batch_size(self):
+        """
+        Number of invoices processed per transaction by the HKA crons, set by
+        the system parameter `hka.cron.batch`.
+
+        :rtype: int
+        """
+        batch_size = int(self.env['ir.config_parameter'].sudo().get_param('hka.cron.batch', 200))
+        return max(batch_size, 1)
+
+    @api.model
+    def _get_hka_max_workers(self):
+        """
+        Number of concurrent HTTP calls the HKA crons issue, set by the system
+        parameter `hka.cron.workers`.
+
+        :rtype: int
+        """
+        max_workers = int(self.env['ir.config_parameter'].sudo().get_param('hka.cron.workers', 4))
+        return max(max_workers, 1)
+
+    def _send_hka_batch(self, connector):
+        """
+        Send a batch of invoices to HKA.
+
+        Payloads are built first, or reused from a previous failed attempt, then
+        sent concurrently with `HKAConnector.send_documents`; all the ORM work
+        stays in the calling thread. Results are written at the end
+        with one `write()` per distinct set of values; the retry counters of the
+        failed invoices are incremented in one UPDATE.
+
+        The XML files returned by HKA are not attached here: the caller commits
+        the sending results first, so a file failing to attach cannot roll back
+        invoices HKA already issued (see `_attach_hka_files`).
+
+        :param connector: HKAConnector instance.
+        :return: Files to attach, as expected by `_attach_hka_files`.
+        :rtype: list
+        """
+        self._prefetch_hka_payload()
+        sent_date = fields.Datetime.now()
+        # Issuer and customer data are built once per company and partner; the
+        # emission time and the immediate payment term once for the batch
+        invoices = self.with_context(
+            hka_emisor_cache={company.id: company._prepare_hka_emisor() for company in self.company_id},
+            hka_receptor_cache={partner.id: partner._prepare_hka_receptor() for partner in self.partner_id},
+            hka_emission_time=fields.Datetime.context_timestamp(self, sent_date).strftime("%H:%M:%S"),
+            hka_immediate_term_id=self._get_hka_immediate_term_id(),
+        )
+        ext, mimetype = _FILE_TYPES['XML']
+
+        vals_by_id = {}
+        files = []
+        failed_ids = []
+
+        def fail(invoice, error):
+            vals_by_id[invoice.id] = {'hka_error_msg': str(error)}
+            failed_ids.append(invoice.id)
+            _logger.error("Error al enviar %s a HKA: %s", invoice.name, error)
+
+        payloads = {}
+        built = set()
+        for invoice in invoices:
+            try:
+                rejection = invoice._check_hka_required_data()
+                if rejection:
+                    vals_by_id[invoice.id] = rejection
+                    failed_ids.append(invoice.id)
+                    continue
+
+                # A failing query must not abort the transaction of the whole batch
+                with self.env.cr.savepoint(flush=False):
+                    payload = invoice._get_hka_cached_payload()
+                    if payload is None:
+                        payload = invoice._prepare_hka_payload()
+                        built.add(invoice)
+                payloads[invoice] = payload
+            except Exception as e:
+                fail(invoice, e)
+
+        if payloads:
+            responses = connector.send_documents(list(payloads.values()), max_workers=self._get_hka_max_workers())
+
+            for invoice, resp in zip(payloads, responses):
+                try:
+                    if isinstance(resp, HKASendUncertainError):
+                        # Reenviarla podría duplicar el documento: queda para revisión manual
+                        vals_by_id[invoice.id] = {'hka_status': 'unknown', 'hka_error_msg': str(resp)}
+                        _logger.warning("Envío de %s a HKA sin confirmar: %s", invoice.name, resp)
+                        continue
+                    if isinstance(resp, Exception):
+                        raise resp
+                    vals, xml_b64 = invoice._process_hka_response(resp, sent_date=sent_date)
+                    vals_by_id[invoice.id] = vals
+                    if vals['hka_status'] != 'sent':
+                        failed_ids.append(invoice.id)
+                    elif invoice.hka_payload_date:
+                        vals.update(self._clear_hka_payload_vals())
+                    if xml_b64:
+                        files.append(('hka_xml_file', invoice._prepare_attachment_vals(xml_b64, ext, mimetype)))
+                except Exception as e:
+                    fail(invoice, e)
+
+            now = self.env.cr.now()
+            for invoice in invoices.browse(failed_ids):
+                if invoice in built:
+                    invoice._cache_hka_payload(payloads[invoice])
+                elif invoice in payloads:
+                    # Payload reutilizado: las escrituras de este cron no deben invalidarlo
+                    vals_by_id[invoice.id]['hka_payload_check_date'] = now
+
+        self._write_grouped(vals_by_id)
+        self.browse(failed_ids)._handle_retry()
+        return files
 
-        return True
-    
     @api.model
     def _cron_send_hka(self):
         """
         Cron job to send pending invoices to HKA.
+
+        Invoices are processed in batches of `hka.cron.batch`, committing after
+        each one so row locks are released and finished batches are kept. The
+        sending results are committed before attaching the returned XML files.
         """
         _logger.info("Ejecutando cron de envío a HKA")
         connector = self.env['hka.connector.service'].sudo().get_client()
-        pending_invoices = self.search(self._domain_pending_send())
-
-        for invoice in pending_invoices:
-            try:
-                sent = invoice._send_to_hka(connector)
-                invoice._handle_retry(sent)
+        pending_ids = self.search(self._domain_pending_send()).ids
 
-            except Exception as e:
-                invoice.hka_error_msg = str(e)
-                invoice.hka_retry_count += 1
-                _logger.error("Error al enviar %s a HKA: %s", invoice.name, e)
+        for batch_ids in split_every(self._get_hka_cron_batch_size(), pending_ids):
+            files = self.browse(batch_ids)._send_hka_batch(connector)
+            self.env.cr.commit()  # pylint: disable=invalid-commit
+            self._attach_hka_files(files)
+            self.env.cr.commit()  # pylint: disable=invalid-commit
 
-    def _download_and_attach(self, connector, type, done_field):
+    def _download_and_attach(self, future, type, ext, mimetype):
         """
-        Download a file from HKA and attach it to the invoice.
+        Collect a file downloaded from HKA and prepare its attachment to the invoice.
 
-        :param connector: HKAConnector instance.
+        :param future: Future of the `download_file` call for this invoice.
         :param type: File type ('XML', 'PDF', or 'CDR').
-        :param done_field: Field name to set as True upon success.
+        :param ext: File extension (e.g., 'xml').
+        :param mimetype: MIME type of the file.
+        :return: Values of the attachment to create, or None if nothing was downloaded.
+        :rtype: dict
         """
         try:
-            ext, mimetype = self._FILE_TYPES[type]
-            resp = connector.download_file(self.hka_cpe_number, type)
+            resp = future.result()
 
             if resp.get('codigo') == 0 and resp.get('archivo'):
-                data = base64.b64decode(resp['archivo'])
-                self._attach_file(data, ext, mimetype)
-                setattr(self, done_field, True)
                 _logger.info("%s descargado para %s", type, self.name)
+                return self._prepare_attachment_vals(resp['archivo'], ext, mimetype)
             else:
                 _logger.info("No se pudo descargar %s: %s", type, resp.get('mensaje'))
 
         except Exception as e:
             _logger.error("Error al descargar %s para %s: %s", type, self.name, e)
+
+        return None
     
+    def _download_documents_batch(self, connector):
+        """
+        Download and attach the pending XML, PDF and CDR files of a batch of invoices.
+
+        The HTTP downloads run concurrently in a thread pool, bounded by the
+        system parameter `hka.cron.workers`; everything touching the ORM
+        stays in the calling thread. Attachments and download flags are
+        handled by `_attach_hka_files`.
+
+        :param connector: HKAConnector instance.
+        """
+        self.read(['name', 'hka_cpe_number', 'hka_xml_file', 'hka_pdf_file', 'hka_cdr_file'])
+
+        jobs = [
+            (invoice, download)
+            for invoice in self
+            for download in _DOWNLOADS
+            if not invoice[download[1]]
+        ]
+        if not jobs:
+            return
+
+        # Check the token once before fanning out (see HKAConnector.send_documents)
+        try:
+            connector._ensure_token()
+        except Exception as e:
+            # Los documentos quedan pendientes para la próxima ejecución
+            _logger.error("No se pudo autenticar en HKA para descargar documentos: %s", e)
+            return
+        with ThreadPoolExecutor(max_workers=self._get_hka_max_workers()) as executor:
+            futures = [
+                executor.submit(connector.download_file, invoice.hka_cpe_number, download[0])
+                for invoice, download in jobs
+            ]
+
+        files = []
+        for (invoice, (type, done_field, ext, mimetype)), future in zip(jobs, futures):
+            attachment_vals = invoice._download_and_attach(future, type, ext, mimetype)
+            if attachment_vals:
+                files.append((done_field, attachment_vals))
+
+        self._attach_hka_files(files)
+
     @api.model
     def _cron_download_documents(self):
         """
         Cron job to download and attach XML, PDF and CDR files from HKA.
+
+        Invoices are processed in batches of `hka.cron.batch`, committing after each one.
         """
         _logger.info("Ejecutando cron de descarga de documentos HKA")
         connector = self.env['hka.connector.service'].sudo().get_client()
-        pending_invoices = self.search(self._domain_pending_download())
-
-        for invoice in pending_invoices:
-            if not invoice.hka_xml_file:
-                invoice._download_and_attach(connector, 'XML', 'hka_xml_file')
-
-            if not invoice.hka_pdf_file:
-                invoice._download_and_attach(connector, 'PDF', 'hka_pdf_file')
+        # Only a handful of fields are needed: avoid prefetching every column of account.move
+        invoices = self.with_context(prefetch_fields=False)
+        pending_ids = invoices.search(self._domain_pending_download()).ids
 
-            if not invoice.hka_cdr_file:
-                invoice._download_and_attach(connector, 'CDR', 'hka_cdr_file')
-    
\ No newline at end of file
+        for batch_ids in split_every(self._get_hka_cron_batch_size(), pending_ids):
+            invoices.browse(batch_ids)._download_documents_batch(connector)
+            self.env.cr.commit()  # pylint: disable=invalid-commit
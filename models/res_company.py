@@ -9,4 +9,26 @@ class ResCompany(models.Model):
     hka_test_mode = fields.Boolean(
         string="HKA en modo prueba",
         help="Active this option to use the HKA test environment (OSE/PSE).",
-    )
\ No newline at end of file
+    )
+
+    def _prepare_hka_emisor(self):
+        """
+        Prepare issuer (company) data for the HKA payload.
+
+        :return: Dict with issuer info.
+        :rtype: dict
+        """
+        self.ensure_one()
+        return {
+            "ruc": self.vat or '',
+            "nombreComercial": self.name,
+            # "lugarExpedicion": self.zip or '',
+            "lugarExpedicion": '0000',
+            "domicilioFiscal": self.street or '',
+            "urbanizacion": self.street2 or '',
+            "distrito": self.city or '',
+            "provincia": self.state_id.name or '',
+            "departamento": self.state_id.name or '',
+            "codigoPais": self.country_id.code or '',
+            "ubigeo": self.partner_id.zip or '',
+        }
\ No newline at end of file
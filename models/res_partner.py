@@ -0,0 +1,26 @@
+from odoo import models
+
+
+class ResPartner(models.Model):
+    _inherit = 'res.partner'
+
+    def _prepare_hka_receptor(self):
+        """
+        Prepare customer data for the HKA payload.
+
+        :return: Dict with customer info.
+        :rtype: dict
+        """
+        self.ensure_one()
+        id_type = self.l10n_latam_identification_type_id.l10n_pe_vat_code or ''
+        return {
+            "tipoDocumento": id_type,
+            "numDocumento": self.vat or '',
+            "razonSocial": self.name,
+            "notificar": "NO",
+            "pais": self.country_id.code or '',
+            "provincia": self.state_id.name or '',
+            "departamento": self.state_id.name or '',
+            "distrito": self.city or '',
+            "direccion": self.street or '',
+        }
@@ -1,11 +1,176 @@
+import json
 import logging
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.exceptions import NewConnectionError
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 
 _logger = logging.getLogger(__name__)
 
 
+class HKACircuitOpenError(Exception):
+    """
+    Raised without contacting HKA while its circuit breaker is open.
+    """
+
+
+class HKASendUncertainError(Exception):
+    """
+    Raised when a document may or may not have been received by HKA: the
+    connection failed or HKA answered an error after the request was sent.
+    """
+
+
+class _CircuitBreaker:
+    """
+    Thread-safe circuit breaker shared by the connectors of the process.
+
+    It opens after `fail_max` consecutive failed calls, and calls then fail at
+    once with `HKACircuitOpenError` for `reset_timeout` seconds. After that a
+    single probe call is let through (half-open): its success closes the
+    breaker, its failure opens it again.
+    """
+
+    def __init__(self, fail_max=5, reset_timeout=30):
+        self.fail_max = fail_max
+        self.reset_timeout = reset_timeout
+        self._lock = threading.Lock()
+        self._fail_count = 0
+        self._opened_at = None
+
+    def before_call(self):
+        """
+        :raises HKACircuitOpenError: If the breaker is open.
+        """
+        with self._lock:
+            if self._opened_at is None:
+                return
+            if time.monotonic() - self._opened_at < self.reset_timeout:
+                raise HKACircuitOpenError("HKA no está disponible, se reintentará más tarde.")
+            # Half-open: this call probes the service, the others keep failing fast
+            self._opened_at = time.monotonic()
+
+    def record_success(self):
+        with self._lock:
+            self._fail_count = 0
+            self._opened_at = None
+
+    def record_failure(self):
+        with self._lock:
+            self._fail_count += 1
+            if self._fail_count >= self.fail_max:
+                if self._opened_at is None:
+                    _logger.warning("HKA failed %s times in a row. Pausing calls for %s seconds.",
+                                    self._fail_count, self.reset_timeout)
+                self._opened_at = time.monotonic()
+
+
+def _token_fingerprint(token):
+    """
+    Shorten a token to a prefix safe to write in the logs.
+
+    :param token: HKA token.
+    :rtype: str
+    """
+    return f"{token[:6]}…" if token else str(token)
+
+
+def _parse_expiry(value):
+    """
+    Parse the token expiration date returned by HKA ('YYYY-MM-DD HH:MM:SS').
+
+    Uses the C-implemented `datetime.fromisoformat`, falling back to
+    `strptime` for any other shape.
+
+    :param value: Expiration date as returned by HKA.
+    :rtype: datetime
+    """
+    try:
+        return datetime.fromisoformat(value)
+    except ValueError:
+        return datetime.strptime(value, "%Y-%m-%d %H:%M:%S")
+
+
+def _request_not_sent(error):
+    """
+    Tell whether a requests error surely happened before the request was sent.
+
+    Only connect timeouts and failures to open a new connection qualify; other
+    connection errors (disconnections, TLS errors) may happen once HKA already
+    received the body.
+
+    :param error: Exception raised by requests.
+    :rtype: bool
+    """
+    if isinstance(error, requests.ConnectTimeout):
+        return True
+    reason = getattr(error.args[0], 'reason', None) if error.args else None
+    return isinstance(reason, NewConnectionError)
+
+
+def _build_session():
+    """
+    Build the HTTP session shared by every HKA connector of the worker process.
+
+    :return: Session with a keep-alive connection pool mounted for HTTP and HTTPS.
+    :rtype: requests.Session
+    """
+    session = requests.Session()
+    adapter = HTTPAdapter(pool_connections=10, pool_maxsize=20, max_retries=0)
+    session.mount('http://', adapter)
+    session.mount('https://', adapter)
+    return session
+
+
+def json_dumps(data):
+    """
+    Serialize data to a JSON string, using orjson when it is installed.
+
+    :param data: JSON-serializable object.
+    :return: JSON document.
+    :rtype: str
+    """
+    if orjson is not None:
+        return orjson.dumps(data).decode()
+    return json.dumps(data)
+
+
+def json_encode(data):
+    """
+    Serialize data to a UTF-8 encoded JSON document, ready to be sent as a request body.
+
+    :param data: JSON-serializable object.
+    :return: JSON document.
+    :rtype: bytes
+    """
+    if orjson is not None:
+        return orjson.dumps(data)
+    return json.dumps(data).encode()
+
+
+def json_loads(data):
+    """
+    Parse a JSON document, using orjson when it is installed.
+
+    :param data: JSON document.
+    :type data: bytes or str
+    :return: Parsed object.
+    """
+    if orjson is not None:
+        return orjson.loads(data)
+    return json.loads(data)
+
+
 class HKAConnector:
     """
     Connector client for The Factory HKA (OSE/PSE) web service API.
@@ -19,10 +184,36 @@ class HKAConnector:
     Attributes:
         TEST_URL (str): URL for test environment.
         PROD_URL (str): URL for production environment.
+        _session (requests.Session): Keep-alive session shared by all the
+            connectors of the process, so connections outlive each instance.
+        _token_cache (dict): Tokens and expirations of the process, keyed by
+            (database name, company id).
+        _auth_locks (dict): Locks serializing the authentications of each
+            (database name, company id), so concurrent callers share a single
+            new token without waiting on the logins of other companies.
+        _breakers (dict): Circuit breaker of each environment, keyed by base URL.
     """
 
-    TEST_URL = "http://demoint.thefactoryhka.com.pe/clients/ServiceClients.svc"
-    PROD_URL = "http://prod.thefactoryhka.com.pe/clients/ServiceClients.svc"
+    TEST_URL = "https://demoint.thefactoryhka.com.pe/clients/ServiceClients.svc"
+    PROD_URL = "https://prod.thefactoryhka.com.pe/clients/ServiceClients.svc"
+
+    # Test mode -> (base URL, application type)
+    _MODE_CONFIG = {True: (TEST_URL, "I"), False: (PROD_URL, "P")}
+
+    _JSON_HEADERS = {"Content-Type": "application/json"}
+
+    # (connect, read) timeouts in seconds: fail fast when HKA is unreachable,
+    # but let it take its time processing a request once connected
+    _AUTH_TIMEOUT = (3.05, 30)
+    _REQUEST_TIMEOUT = (3.05, 60)
+
+    # Seconds before expiry at which the token is already renewed
+    TOKEN_REFRESH_SKEW_SECONDS = 60
+
+    _session = _build_session()
+    _token_cache = {}
+    _auth_locks = {}
+    _breakers = {TEST_URL: _CircuitBreaker(), PROD_URL: _CircuitBreaker()}
 
     def __init__(self, env):
         """
@@ -31,28 +222,98 @@ class HKAConnector:
         :param env: Odoo environment (self.env)
         """
         self.env = env
+        # Only the creating thread may use `env` (and its cursor): tokens
+        # obtained from other threads (concurrent sends and downloads) are
+        # kept in memory only
+        self._env_thread = threading.get_ident()
         company = env.user.company_id
-        self.ruc = company.vat
-        self.user = company.hka_user
-        self.password = company.hka_password
+        # One read for all the configuration fields
+        company_data = company.read(['vat', 'hka_user', 'hka_password', 'hka_test_mode'])[0]
+        self.ruc = company_data['vat']
+        self.user = company_data['hka_user']
+        self.password = company_data['hka_password']
+        self.base_url, self.app_type = self._MODE_CONFIG[bool(company_data['hka_test_mode'])]
 
-        if company.hka_test_mode:
-            self.base_url = self.TEST_URL
-            self.app_type = "I"
-        else:
-            self.base_url = self.PROD_URL
-            self.app_type = "P"
-        
-        _logger.info(
-            "HKA Connector initialized with base_url: %s, app_type: %s, user: %s, password: %s, ruc: %s", 
-            self.base_url, self.app_type, self.user, self.password, self.ruc
+        _logger.debug(
+            "HKA Connector initialized with base_url: %s, app_type: %s, ruc: %s",
+            self.base_url, self.app_type, self.ruc
         )
 
-        config = env['hka.connector.config'].sudo().get_singleton()
-        _logger.info("config HKA: %s", config)
+        # Request pieces that only depend on the company configuration
+        self._url_autenticacion = f"{self.base_url}/Autenticacion"
+        self._url_enviar = f"{self.base_url}/Enviar"
+        self._url_descarga = f"{self.base_url}/DescargaArchivo"
+        self._auth_payload = {
+            "usuario": self.user,
+            "clave": self.password,
+            "ruc": self.ruc,
+            "tipoAplicacion": self.app_type,
+        }
+        self._base_body = {"ruc": self.ruc}
+        self._breaker = self._breakers[self.base_url]
+
+        self._token_key = (env.cr.dbname, company.id)
+        # setdefault is atomic: every connector of a company gets the same lock
+        self._auth_lock = self._auth_locks.setdefault(self._token_key, threading.Lock())
+        cached_token = self._token_cache.get(self._token_key)
+        if cached_token:
+            self._set_token(*cached_token)
+        else:
+            config = env['hka.connector.config'].sudo().get_singleton()
+            _logger.debug("config HKA: %s", config)
+
+            self._set_token(config.token, config.token_expiry)
+
+    def _post_with_retry(self, url, body, timeout, idempotent=True, max_retries=3, base=1.0, cap=30.0):
+        """
+        POST a JSON body to HKA, retrying transient failures.
+
+        Connection errors, timeouts, 429 and 5xx responses are retried up to
+        `max_retries` times, sleeping a random delay between 0 and
+        `min(cap, base * 2 ** attempt)` seconds (exponential backoff with full
+        jitter) so workers do not retry in lockstep. Other errors are raised at once.
+
+        A non-idempotent request (`/Enviar`) may already have been processed by
+        HKA when the response is lost, so it is only retried when it surely was
+        not: failures to connect (see `_request_not_sent`), 429 and 503.
+
+        Calls that still fail after the retries count towards the circuit
+        breaker; while it is open, no request is made at all.
+
+        :param url: Endpoint URL.
+        :param body: JSON-serializable request body.
+        :param timeout: Timeout passed to requests, as a (connect, read) tuple or a scalar.
+        :param idempotent: Whether the request can be replayed after read
+            timeouts and any 5xx response.
+        :return: Successful response.
+        :rtype: requests.Response
+        :raises HTTPError: If the request fails with a non-recoverable status
+            or keeps failing after the last retry.
+        :raises HKACircuitOpenError: If the circuit breaker is open.
+        """
+        self._breaker.before_call()
+        data = json_encode(body)
+        for attempt in range(max_retries + 1):
+            try:
+                resp = self._session.post(url, data=data, headers=self._JSON_HEADERS, timeout=timeout)
+            except (requests.ConnectionError, requests.Timeout) as e:
+                if attempt >= max_retries or not (idempotent or _request_not_sent(e)):
+                    self._breaker.record_failure()
+                    raise
+                _logger.warning("HKA request to %s failed: %s. Retrying.", url, e)
+            else:
+                if resp.status_code != 429 and resp.status_code < 500:
+                    # HKA answered: it is up even if it rejected the request
+                    self._breaker.record_success()
+                    resp.raise_for_status()
+                    return resp
+                retryable = idempotent or resp.status_code in (429, 503)
+                if attempt >= max_retries or not retryable:
+                    self._breaker.record_failure()
+                    resp.raise_for_status()
+                _logger.warning("HKA request to %s answered %s. Retrying.", url, resp.status_code)
 
-        self.token = config.token
-        self.token_expiry = config.token_expiry
+            time.sleep(random.uniform(0, min(cap, base * 2 ** attempt)))
 
     def authenticate(self):
         """
@@ -61,43 +322,104 @@ class HKAConnector:
         :raises HTTPError: If the authentication request fails.
         :raises ValueError: If the response indicates an authentication error.
         """
-        url = f"{self.base_url}/Autenticacion"
-        payload = {
-            "usuario": self.user,
-            "clave": self.password,
-            "ruc": self.ruc,
-            "tipoAplicacion": self.app_type,
-        }
-
         _logger.info("Authenticating to HKA with user: %s", self.user)
-        resp = requests.post(url, json=payload, timeout=30)
-        resp.raise_for_status()
-        data = resp.json()
+        resp = self._post_with_retry(self._url_autenticacion, self._auth_payload, timeout=self._AUTH_TIMEOUT)
+        data = json_loads(resp.content)
 
-        _logger.info("response HKA: %s", data)
+        _logger.info("response HKA: token %s, expiration %s",
+                     _token_fingerprint(data.get('token')), data.get('fechaExpiracion'))
         
         # if data.get('codigo') != '0':
         #     raise ValueError(f"HKA Auth error: {data.get('mensaje')}")
         
-        expiry = datetime.strptime(data['fechaExpiracion'], "%Y-%m-%d %H:%M:%S")
-        config = self.env['hka.connector.config'].sudo().get_singleton()
-        config.write({
-            'token': data['token'],
-            'token_expiry': expiry,
-        })
+        expiry = _parse_expiry(data['fechaExpiracion'])
+        if threading.get_ident() == self._env_thread:
+            config = self.env['hka.connector.config'].sudo().get_singleton()
+            config.write({
+                'token': data['token'],
+                'token_expiry': expiry,
+            })
         
-        self.token = data['token']
-        self.token_expiry = expiry
+        self._set_token(data['token'], expiry)
+        self._token_cache[self._token_key] = (self.token, expiry)
 
         _logger.info("HKA authentication successful. Token valid until: %s", expiry)
 
+    def _set_token(self, token, expiry):
+        """
+        Set the token in use and its expiration date.
+
+        :param token: HKA token.
+        :param expiry: Expiration date of the token.
+        :type expiry: datetime
+        """
+        self.token = token
+        self.token_expiry = expiry
+        self._token_expiry_ts = expiry.timestamp() if expiry else None
+
+    def _token_expired(self):
+        """
+        Check whether the token is missing or expires within `TOKEN_REFRESH_SKEW_SECONDS`.
+
+        The expiry is compared as epoch seconds (`_token_expiry_ts`),
+        `token_expiry` is kept for display.
+
+        :rtype: bool
+        """
+        return not self.token or self._token_expiry_ts is None \
+            or time.time() >= self._token_expiry_ts - self.TOKEN_REFRESH_SKEW_SECONDS
+
     def _ensure_token(self):
         """
         Ensure that the token is valid. If not, authenticate again.
+
+        The token is renewed `TOKEN_REFRESH_SKEW_SECONDS` before it expires, so
+        it cannot expire in the middle of a long request. Authentications are
+        serialized per company by `_auth_lock`: callers that waited for it take
+        the token just cached by the thread holding it instead of
+        authenticating again.
+        """
+        if not self._token_expired():
+            return
+
+        with self._auth_lock:
+            cached_token = self._token_cache.get(self._token_key)
+            if cached_token:
+                self._set_token(*cached_token)
+            if self._token_expired():
+                _logger.info("HKA token missing or expired. Re-authenticating.")
+                self.authenticate()
+
+    def _post_authenticated(self, url, body, timeout, idempotent=True):
+        """
+        POST a body with the current token, re-authenticating once if HKA
+        rejects the token (401/403) before its local expiry.
+
+        :param url: Endpoint URL.
+        :param body: JSON-serializable request body, without the token.
+        :param timeout: Timeout passed to requests.
+        :param idempotent: See `_post_with_retry`.
+        :return: Successful response.
+        :rtype: requests.Response
+        :raises HTTPError: If the request fails.
         """
-        if not self.token or not self.token_expiry or datetime.now() >= self.token_expiry:
-            _logger.info("HKA token missing or expired. Re-authenticating.")
-            self.authenticate()
+        self._ensure_token()
+        token = self.token
+        try:
+            return self._post_with_retry(url, {**body, "token": token}, timeout, idempotent=idempotent)
+        except requests.HTTPError as e:
+            if e.response is None or e.response.status_code not in (401, 403):
+                raise
+            _logger.info("HKA token rejected. Re-authenticating.")
+
+        with self._auth_lock:
+            # The token was revoked: do not hand it to other connectors,
+            # unless another thread already replaced it
+            if self._token_cache.get(self._token_key, (None,))[0] == token:
+                del self._token_cache[self._token_key]
+        self.token = None
+        self._ensure_token()
+        return self._post_with_retry(url, {**body, "token": self.token}, timeout, idempotent=idempotent)
 
     def send_document(self, payload):
         """
@@ -108,22 +430,69 @@ class HKAConnector:
         :return: Response from the HKA API.
         :rtype: dict
         :raises HTTPError: If the request fails.
+        :raises HKASendUncertainError: If HKA may have received the document
+            although the request failed.
         """
-        self._ensure_token()
-        url = f"{self.base_url}/Enviar"
         body = {
             "documentoElectronico": payload,
-            "ruc": self.ruc,
-            "token": self.token,
+            **self._base_body,
         }
 
-        _logger.info("Sending electronic document to HKA: %s", body)
-        resp = requests.post(url, json=body, timeout=60)
-        resp.raise_for_status()
-        _logger.info("HKA response: %s", resp.text)
+        debug = _logger.isEnabledFor(logging.DEBUG)
+        if debug:
+            _logger.debug("Sending electronic document to HKA: %s", json_dumps(payload))
+        try:
+            resp = self._post_authenticated(self._url_enviar, body, self._REQUEST_TIMEOUT, idempotent=False)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if _request_not_sent(e):
+                raise
+            raise HKASendUncertainError(f"No se pudo confirmar la recepción del documento en HKA: {e}") from e
+        except requests.HTTPError as e:
+            if e.response is not None and e.response.status_code >= 500 and e.response.status_code != 503:
+                raise HKASendUncertainError(f"No se pudo confirmar la recepción del documento en HKA: {e}") from e
+            raise
+        if debug:
+            _logger.debug("HKA response: %s", resp.text)
 
-        return resp.json()
+        return json_loads(resp.content)
     
+    def send_documents(self, payloads, max_workers=8):
+        """
+        Send several electronic documents concurrently over the shared session.
+
+        HKA's `/Enviar` endpoint takes a single document, so the documents are
+        sent in parallel requests. The token is checked before fanning out, so
+        the worker threads normally share it. A worker re-authenticates only if
+        the token is rejected or expires during the batch, and that token is
+        kept in memory: only the thread that created the connector writes it
+        through the ORM (see `authenticate`).
+
+        :param payloads: Electronic documents to send.
+        :type payloads: list
+        :param max_workers: Maximum number of concurrent requests.
+        :type max_workers: int
+        :return: Responses from the HKA API in the order of `payloads`; a
+            document whose sending failed gets the raised exception instead,
+            and all of them get it when no token can be obtained.
+        :rtype: list
+        """
+        if not payloads:
+            return []
+
+        try:
+            self._ensure_token()
+        except Exception as e:
+            # Sin token no se puede enviar ningún documento (p. ej. circuito abierto)
+            return [e] * len(payloads)
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [executor.submit(self.send_document, payload) for payload in payloads]
+
+        results = []
+        for future in futures:
+            error = future.exception()
+            results.append(error if error is not None else future.result())
+        return results
+
     def download_file(self, document_number, file_type):
         """
         Download a file (XML, CDR, PDF) for a given document number.
@@ -136,20 +505,38 @@ class HKAConnector:
         :rtype: dict
         :raises HTTPError: If the request fails.
         """
-        self._ensure_token()
         full_document = f"{self.ruc}-{document_number}"
-        url = f"{self.base_url}/DescargaArchivo"
         payload = {
-            "ruc":         self.ruc,
-            "token":       self.token,
+            **self._base_body,
             "documento":   full_document,
             "tipoArchivo": file_type,
         }
 
         _logger.info("Downloading %s for document %s", file_type, full_document)
-        resp = requests.post(url, json=payload, timeout=60)
-        resp.raise_for_status()
-        data = resp.json()
+        resp = self._post_authenticated(self._url_descarga, payload, timeout=self._REQUEST_TIMEOUT)
+        data = json_loads(resp.content)
         
-        _logger.info("Download response for %s: %s", file_type, data)
+        if _logger.isEnabledFor(logging.DEBUG):
+            _logger.debug("Download response for %s: %s", file_type, {
+                key: value for key, value in data.items() if key != 'archivo'
+            })
         return data
+
+    def download_files(self, document_number, file_types=('XML', 'CDR', 'PDF')):
+        """
+        Download several files of a document concurrently over the shared session.
+
+        The token is checked before fanning out, as in `send_documents`.
+
+        :param document_number: Document identifier, e.g., '01-F002-1'.
+        :type document_number: str
+        :param file_types: Types of file to download.
+        :type file_types: tuple
+        :return: Responses from the HKA API keyed by file type.
+        :rtype: dict
+        :raises HTTPError: If any of the requests fails.
+        """
+        self._ensure_token()
+        with ThreadPoolExecutor(max_workers=len(file_types) or 1) as executor:
+            responses = executor.map(lambda file_type: self.download_file(document_number, file_type), file_types)
+            return dict(zip(file_types, responses))